@@ -0,0 +1,381 @@
+import pandas as pd
+
+import os
+import time
+import datetime
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor,Future
+from concurrent.futures.process import BrokenProcessPool
+
+from cycling_data import CyclingData,Cyclist
+
+
+class FolderSink:
+    """
+    Stores the processed activities in a folder:
+        <folder>/frames/<hash>.pkl : processed dataframe of the activity (CyclingData.get_data())
+        <folder>/summary.csv : one line per activity (see FolderSink.summarize)
+    """
+
+    def __init__(self,folder:str="processed")->None:
+        """
+        Args:
+            folder (str, optional): output folder. Defaults to "processed".
+        """
+        self.folder = folder
+        self.summary_path = os.path.join(folder,"summary.csv")
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(folder,"frames"),exist_ok=True)
+
+    def known_hashes(self)->set:
+        """
+        Returns:
+            set: content hashes of the activities already stored, so that they are not processed again after a restart
+        """
+        if not os.path.exists(self.summary_path):
+            return set()
+        try:
+            return set(pd.read_csv(self.summary_path)["hash"])
+        except pd.errors.EmptyDataError:
+            return set()
+
+    def write(self,filename:str,content_hash:str,frame:pd.DataFrame,summary:dict)->None:
+        """
+        Args:
+            filename (str): name of the .fit file
+            content_hash (str): sha256 of the .fit file
+            frame (pd.DataFrame): processed data of the activity (CyclingData.get_data())
+            summary (dict): global informations of the activity (FolderSink.summarize)
+        """
+        frame.to_pickle(os.path.join(self.folder,"frames",f"{content_hash}.pkl"))
+
+        summary = pd.DataFrame([{"filename":filename,"hash":content_hash,**summary}])
+        with self._lock:
+            is_empty = not os.path.exists(self.summary_path) or os.path.getsize(self.summary_path)==0
+            summary.to_csv(self.summary_path,mode="a",header=is_empty,index=False)
+
+    @staticmethod
+    def summarize(activity:CyclingData)->dict:
+        """
+        Returns:
+            dict: global informations of the activity (same as CyclingData.show_global_informations)
+        """
+        data = activity.data
+        return {
+            "start":data["time"].min(),
+            "duration":data["time_delta"].sum(), # s
+            "distance":data["position"].max()/1000, # km
+            "elevation_gain":data[data["altitude_delta"]>0]["altitude_delta"].sum(), # m
+            "heart_rate":data["heart_rate"].mean(), # bpm
+            "energy":(data["watts"]*data["time_delta"]).sum()/1000, # kJ
+            "ppo":activity.estimate_ppo(), # W
+            "ftp":activity.estimate_ftp(), # W
+            "normalized_power":activity.get_normalized_power(), # W
+            "tss":activity.get_training_stress_score(),
+        }
+
+
+def process_activity(filename:str,cyclist:Cyclist)->tuple:
+    """
+    Work done in a worker process of ActivityWatcher (top level function so that it can be sent to the process).
+
+    Args:
+        filename (str): name of the file in the activities folder
+        cyclist (Cyclist): profile of the cyclist
+
+    Returns:
+        tuple: (processed data of the activity, summary of the activity)
+    """
+    activity = CyclingData(filename,cyclist=cyclist)
+    return activity.get_data(),FolderSink.summarize(activity)
+
+
+class ActivityWatcher:
+    """
+    Watches the activities folder and processes the new .fit files (dropped by sync tools) with a bounded pool of worker processes (decoding and computations are CPU bound, threads would be limited by the GIL).
+
+    - a file is processed once its size and modification time have not changed for <debounce> seconds (files still being written are ignored)
+    - files are deduplicated by the sha256 of their content, so a ride synced twice is processed once
+    - at most <max_workers> files are processed at the same time and at most <max_queue> files wait for a worker, the others are picked at a next poll
+
+    Usage:
+        watcher = ActivityWatcher(FolderSink("processed"),cyclist=Cyclist(70,1.80))
+        watcher.start()
+        ...
+        watcher.get_stats()
+        watcher.stop()
+    """
+
+    folder = "activites" # CyclingData reads the files from this folder
+
+    def __init__(
+        self,
+        sink:FolderSink=None,
+        cyclist:Cyclist=None,
+        max_workers:int=2,
+        max_queue:int=16,
+        debounce:float=5.0,
+        poll_interval:float=2.0
+    )->None:
+        """
+        Args:
+            sink (FolderSink, optional): where the processed activities are stored, any object with known_hashes() and write(filename,content_hash,frame,summary). Defaults to FolderSink().
+            cyclist (Cyclist, optional): profile of the cyclist. Defaults to CyclingData.cyclist.
+            max_workers (int, optional): number of activities processed at the same time. Defaults to 2.
+            max_queue (int, optional): number of activities waiting for a worker. Defaults to 16.
+            debounce (float, optional): time (s) a file must stay unchanged before being processed. Defaults to 5.0.
+            poll_interval (float, optional): time (s) between two scans of the folder. Defaults to 2.0.
+        """
+        self.sink = sink if sink is not None else FolderSink()
+        self.cyclist = cyclist if cyclist is not None else CyclingData.cyclist # resolved here, the default of the worker processes may differ
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+        self.max_workers = max_workers
+
+        self._executor = None # created by start, so that the watcher can be restarted after stop
+        self._slots = threading.BoundedSemaphore(max_workers+max_queue)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self._hashes = self.sink.known_hashes() # processed or being processed
+        self._observed = {} # path -> (size, mtime, time since which the file is unchanged)
+        self._done = {} # path -> (size, mtime) of files already handled
+        self._retry = set() # paths to submit again, their worker process died
+        self._broken = False # a worker process died, the pool must be recreated
+
+        self._in_flight = 0 # submitted and not finished
+        self._processed = 0
+        self._failed = 0
+        self._duplicates = 0
+        self._latencies = deque(maxlen=100) # s, from submission to end of processing of the last files
+
+    ##############
+    # LIFE CYCLE #
+    ##############
+
+    def start(self)->None:
+        """
+        Starts watching the folder in a background thread.
+        """
+        assert self._thread is None,"Watcher already started"
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._watch,daemon=True)
+        self._thread.start()
+
+    def stop(self,wait:bool=True)->None:
+        """
+        Stops watching the folder.
+
+        Args:
+            wait (bool, optional): wait for the activities already submitted to be processed. Defaults to True.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _watch(self)->None:
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error while scanning {self.folder}: {e}")
+            self._stop_event.wait(self.poll_interval)
+
+    ###########
+    # POLLING #
+    ###########
+
+    def poll(self)->int:
+        """
+        Scans the folder once and submits the files ready to be processed. The watcher must be started.
+
+        Returns:
+            int: number of files submitted
+        """
+        assert self._executor is not None,"Please start the watcher before polling"
+        with self._lock:
+            broken,self._broken = self._broken,False
+            retry,self._retry = self._retry,set()
+        if broken:
+            self._restart_executor()
+        for path in retry:
+            self._done.pop(path,None)
+
+        now = time.monotonic()
+        submitted = 0
+        seen = set()
+
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not entry.name.endswith(".fit"):
+                continue
+
+            try:
+                stat = entry.stat()
+            except OSError as e:
+                print(f"Error while reading {entry.name}: {e}") # removed during the scan, permissions...
+                continue
+            seen.add(entry.path)
+            signature = (stat.st_size,stat.st_mtime)
+            if self._done.get(entry.path)==signature:
+                continue
+
+            # debounce files still being written
+            size,mtime,since = self._observed.get(entry.path,(None,None,now))
+            if (size,mtime)!=signature:
+                self._observed[entry.path] = (*signature,now)
+                continue
+            if now-since < self.debounce:
+                continue
+
+            # bounded queue, the file will be picked at a next poll
+            if not self._slots.acquire(blocking=False):
+                continue
+
+            try:
+                content_hash = ActivityWatcher.hash_file(entry.path)
+            except OSError as e:
+                print(f"Error while reading {entry.name}: {e}")
+                self._slots.release()
+                continue
+            with self._lock:
+                is_duplicate = content_hash in self._hashes
+                if is_duplicate:
+                    self._duplicates += 1
+                else:
+                    self._hashes.add(content_hash)
+                    self._in_flight += 1
+
+            del self._observed[entry.path]
+            self._done[entry.path] = signature
+
+            if is_duplicate:
+                self._slots.release()
+                continue
+
+            try:
+                future = self._executor.submit(process_activity,entry.name,self.cyclist)
+            except Exception as e:
+                # roll back, the file will be submitted again at a next poll
+                print(f"Error while submitting {entry.name}: {e}")
+                if isinstance(e,BrokenProcessPool):
+                    self._restart_executor()
+                with self._lock:
+                    self._hashes.discard(content_hash)
+                    self._in_flight -= 1
+                del self._done[entry.path]
+                self._slots.release()
+                continue
+            future.add_done_callback(self._get_callback(entry.path,content_hash,time.monotonic()))
+            submitted += 1
+
+        # forget deleted or renamed files
+        for path in set(self._observed)-seen:
+            del self._observed[path]
+        for path in set(self._done)-seen:
+            del self._done[path]
+
+        return submitted
+
+    def _restart_executor(self)->None:
+        """
+        Replaces the pool of worker processes, which cannot be used anymore once one of its processes died (out of memory, killed).
+        """
+        print("Worker process died, restarting the pool")
+        self._executor.shutdown(wait=False)
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def _get_callback(self,path:str,content_hash:str,submitted_at:float):
+        """
+        Returns:
+            function: stores the result of the worker in the sink and updates the metrics, called when the future is done
+        """
+        filename = os.path.basename(path)
+
+        def on_done(future:Future)->None:
+            broken = False
+            try:
+                frame,summary = future.result()
+                self.sink.write(filename,content_hash,frame,summary)
+                failed = False
+            except BrokenProcessPool:
+                broken = True # not processed, submitted again to the next pool
+                failed = False
+            except Exception as e:
+                print(f"Error while processing {filename}: {e}")
+                failed = True
+
+            with self._lock:
+                self._in_flight -= 1
+                if broken:
+                    self._broken = True
+                    self._hashes.discard(content_hash)
+                    self._retry.add(path)
+                elif failed:
+                    self._failed += 1
+                    self._hashes.discard(content_hash) # processed again if the file is synced again
+                else:
+                    self._processed += 1
+                    self._latencies.append(time.monotonic()-submitted_at)
+            self._slots.release()
+
+        return on_done
+
+    @staticmethod
+    def hash_file(path:str)->str:
+        """
+        Returns:
+            str: sha256 of the content of the file
+        """
+        sha = hashlib.sha256()
+        with open(path,"rb") as file:
+            for chunk in iter(lambda: file.read(1<<20),b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    ###########
+    # METRICS #
+    ###########
+
+    def get_stats(self)->dict:
+        """
+        Returns:
+            dict:
+                queue_depth: files waiting for a worker (estimated from the files submitted and not finished)
+                running: files being processed (same)
+                processed: files processed since start
+                failed: files that could not be processed
+                duplicates: files skipped because their content was already processed
+                mean_latency: mean time (s) between submission and end of processing, over the last 100 files
+                last_latency: same for the last processed file (s)
+        """
+        with self._lock:
+            running = min(self._in_flight,self.max_workers)
+            return {
+                "queue_depth":self._in_flight-running,
+                "running":running,
+                "processed":self._processed,
+                "failed":self._failed,
+                "duplicates":self._duplicates,
+                "mean_latency":sum(self._latencies)/len(self._latencies) if self._latencies else None,
+                "last_latency":self._latencies[-1] if self._latencies else None,
+            }
+
+
+if __name__=="__main__":
+    watcher = ActivityWatcher()
+    watcher.start()
+    try:
+        while True:
+            time.sleep(60)
+            print(datetime.datetime.now().strftime("%H:%M:%S"),watcher.get_stats())
+    except KeyboardInterrupt:
+        watcher.stop()
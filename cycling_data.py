@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib.colors as colors
 from typing import Literal
+from dataclasses import dataclass,replace
 import datetime
 
 from IPython.display import display,Markdown,HTML
@@ -16,20 +17,54 @@ import numpy as np
 import json
 import requests
 from scipy.stats import gaussian_kde
+from scipy.optimize import lsq_linear
 
 
-class CyclingData:
+@dataclass(frozen=True)
+class Cyclist:
+    """
+    Immutable profile of the cyclist, given to each CyclingData so that several cyclists can be processed at the same time (threads, workers).
+    
+    Attributes:
+        mass (float): mass of the cyclist (kg)
+        size (float): size of the cyclist (m)
+        bike_mass (float): mass of the bike (kg)
+        cda (float): drag coefficient * frontal area (m²), estimated from size and mass if None
+        rolling_resistance (float): Crr, rolling resistance coefficient
+    """
     
     drag_coeffictient = 1.0
+    
+    mass:float = 70
+    size:float = 1.80
+    bike_mass:float = 10
+    cda:float = None
+    rolling_resistance:float = 0.0
+    
+    def __post_init__(self):
+        assert self.size<5,f"Size should be given in meters, and to my knowledge a man cannot be {self.size}m tall "
+        if self.cda is None:
+            projected_frontal_area = 0.0293 * (self.size**0.725) * (self.mass**0.425) + 0.0604
+            object.__setattr__(self,"cda",Cyclist.drag_coeffictient * projected_frontal_area)
+    
+    @property
+    def total_mass(self)->float:
+        """
+        Returns:
+            float: mass + bike_mass (kg)
+        """
+        return self.mass + self.bike_mass
+
+
+class CyclingData:
+    
     g = 9.807
     rho0 = 1.225 # air volumic mass at 0m
     L = 0.0065 # dT°/dz
     T0=288.15 # temperature constant
     R = 287.05 # gas constant
     
-    mass = 70
-    size = 1.80
-    bike_mass = 10
+    cyclist = Cyclist() # default cyclist, used when none is given to the constructor
     
     
     data:pd.DataFrame
@@ -50,15 +85,19 @@ class CyclingData:
         position_delta: distance traveled since last mesure (m)
         slope: slope*100 is slope in %
         watts: (J)
+        power: power measured by a power meter (W), only if available in the .fit file
         
     """
     
-    def __init__(self,filename:str=None,reload_altitude:bool=False)->None:
+    def __init__(self,filename:str=None,reload_altitude:bool=False,cyclist:Cyclist=None)->None:
         """
         Args:
             filename (str): name of the file to be read in activities folder (so complete path to the file is "fit_file/<filename>)
             reload_altitude (bool): sometimes the elevation from the Garmin isn't very accurate, this can be used to replace the altitude data from Garmin by geographical data (from France). Defaults to False.
+            cyclist (Cyclist, optional): profile of the cyclist. Defaults to CyclingData.cyclist.
         """
+        self.cyclist = cyclist if cyclist is not None else CyclingData.cyclist
+        
         if filename==None:
             return
         
@@ -79,7 +118,7 @@ class CyclingData:
         self.data = pd.DataFrame(_data)
         
         if not "heart_rate" in self.data.columns:
-            self.data["heart_rate"] = 180
+            self.data["heart_rate"] = np.nan # no heart rate monitor
         
         
         if "altitude" in self.data.columns:
@@ -104,7 +143,10 @@ class CyclingData:
             inplace=True
         )
         
-        self.data = self.data[["time","position","altitude","speed","heart_rate","lon","lat"]]
+        columns = ["time","position","altitude","speed","heart_rate","lon","lat"]
+        if "power" in self.data.columns:
+            columns.append("power") # activity recorded with a power meter
+        self.data = self.data[columns]
         
         self.data["lon"] = self.data["lon"]/11930465 # type conversion from binary to degrees
         self.data["lat"] = self.data["lat"]/11930465
@@ -116,21 +158,9 @@ class CyclingData:
             except:
                 print("Error while retrieving altitude data")
         
-        # analyse absolute values
-        self.data["time"] = pd.to_datetime(self.data["time"])
-        self.data["drag"] = CyclingData.compute_drag(
-            self.mass,
-            self.size,
-            self.data["speed"],
-            self.data["altitude"]            
-        )
-        self.data["kinetic_energy"] = 0.5 * (self.mass+self.bike_mass) * self.data["speed"]**2
-        self.data["potential_energy"] = (self.mass+self.bike_mass) * CyclingData.g * self.data["altitude"]
-        
-        
-        
         # analyse relative values
-        absolute_columns = ["time","position","altitude","speed","kinetic_energy","potential_energy"]
+        self.data["time"] = pd.to_datetime(self.data["time"])
+        absolute_columns = ["time","position","altitude","speed"]
         for col in absolute_columns:
             self.data[f"{col}_delta"] = self.data[col].diff()
         self.data = self.data.iloc[1:] # first row of delta is all nan
@@ -155,11 +185,32 @@ class CyclingData:
         # in order to remove anomalies, we add a rolling median to our date
         # TODO: added rolling to other variables, like heart rate or altitude earlier
         
+        self.compute_watts()
+    
+    def compute_watts(self)->None:
+        """
+        Computes drag, energies and watts from speed and altitude, with the profile of the cyclist (self.cyclist).
+        """
+        total_mass = self.cyclist.total_mass
+        speed = self.data["speed"]
+        previous_speed = speed - self.data["speed_delta"]
+        
+        self.data["drag"] = CyclingData.compute_drag(
+            self.cyclist,
+            speed,
+            self.data["altitude"]
+        )
+        self.data["kinetic_energy"] = 0.5 * total_mass * speed**2
+        self.data["potential_energy"] = total_mass * CyclingData.g * self.data["altitude"]
+        self.data["kinetic_energy_delta"] = 0.5 * total_mass * (speed**2 - previous_speed**2)
+        self.data["potential_energy_delta"] = total_mass * CyclingData.g * self.data["altitude_delta"]
+        
         energy_delta = self.data["potential_energy_delta"]+self.data["kinetic_energy_delta"] # delta_energy / dt
         applied_power = energy_delta / self.data["time_delta"]
-        drag_power = self.data["drag"]*self.data["speed"]
+        drag_power = self.data["drag"]*speed
+        rolling_power = self.cyclist.rolling_resistance * total_mass * CyclingData.g * speed
         
-        self.data["watts"] = applied_power + drag_power # (watts-drag)*dt = delta_energy
+        self.data["watts"] = applied_power + drag_power + rolling_power # (watts-drag-rolling)*dt = delta_energy
         self.data.loc[self.data["watts"]<0,"watts"] = 0 # remove braking
     
     def get_data(self)->pd.DataFrame:
@@ -183,6 +234,16 @@ class CyclingData:
             
         """
         return self.data.copy()
+    
+    def set_profile(self,cyclist:Cyclist)->None:
+        """
+        Replaces the profile of the cyclist of this activity and recomputes the watts.
+
+        Args:
+            cyclist (Cyclist): new profile
+        """
+        self.cyclist = cyclist
+        self.compute_watts()
 
     def min_periods(self,minutes:int=0,seconds:int=0)->int:
         """
@@ -303,7 +364,7 @@ class CyclingData:
 
 | Energie totale produite | PPO | FTP | VO2MAX | NP | TSS |
 | :---: | :---: | :---: | :---: | :---: | :---: |
-| {(self.data["watts"]*self.data["time_delta"]).sum()/1000:.0f} kJ | {self.estimate_ppo():.0f} W | {self.estimate_ftp()/self.mass:.1f} W/kg | {self.estimate_vo2max():.0f} mL/kg/min | {self.get_normalized_power():.0f} W | {self.get_training_stress_score():.0f} |
+| {(self.data["watts"]*self.data["time_delta"]).sum()/1000:.0f} kJ | {self.estimate_ppo():.0f} W | {self.estimate_ftp()/self.cyclist.mass:.1f} W/kg | {self.estimate_vo2max():.0f} mL/kg/min | {self.get_normalized_power():.0f} W | {self.get_training_stress_score():.0f} |
 
 </center>
 
@@ -452,7 +513,7 @@ class CyclingData:
     
     def show_cardiac_frequency(self):
         
-        if self.data["heart_rate"].max()<1:
+        if self.data["heart_rate"].isna().all():
             print("No heart rate data available")
             return
         
@@ -495,7 +556,7 @@ class CyclingData:
         plt.show()
     
     def show_efficiency(self):
-        if self.get_data()["heart_rate"].max()<1:
+        if self.data["heart_rate"].isna().all():
             print("No heart rate data available")
             return
         
@@ -581,7 +642,7 @@ class CyclingData:
         Returns:
             VO_{2 max}: (mL/kg/min)
         """
-        return (0.01141*self.estimate_ppo() + 0.435) * 1_000 / self.mass
+        return (0.01141*self.estimate_ppo() + 0.435) * 1_000 / self.cyclist.mass
     
     def get_normalized_power(self)->float:
         """
@@ -606,6 +667,95 @@ class CyclingData:
         
         
         
+    #########
+    # ZONES #
+    #########
+    
+    @staticmethod
+    def get_power_zones(ftp:float,fractions:tuple=(0.55,0.75,0.90,1.05,1.20,1.50))->np.ndarray:
+        """
+        Args:
+            ftp (float): W
+            fractions (tuple, optional): lower bounds of zones 2 to n, in fraction of FTP. Defaults to the 7 zones of Coggan.
+
+        Returns:
+            np.ndarray: lower bounds of zones 2 to n (W)
+        """
+        return ftp * np.asarray(fractions,dtype=float)
+    
+    @staticmethod
+    def get_heart_rate_zones(max_heart_rate:float,fractions:tuple=(0.6,0.7,0.8,0.9))->np.ndarray:
+        """
+        Args:
+            max_heart_rate (float): bpm
+            fractions (tuple, optional): lower bounds of zones 2 to n, in fraction of max heart rate. Defaults to 5 zones.
+
+        Returns:
+            np.ndarray: lower bounds of zones 2 to n (bpm)
+        """
+        return max_heart_rate * np.asarray(fractions,dtype=float)
+    
+    def get_time_in_zones(self,column:Literal["watts","power","heart_rate"],zones:np.ndarray)->pd.Series:
+        """
+        Args:
+            column (str): quantity to split into zones
+            zones (np.ndarray): lower bounds of zones 2 to n (see get_power_zones and get_heart_rate_zones)
+
+        Returns:
+            pd.Series: time spent in each zone (s), indexed by "Z1" to "Zn"
+        """
+        return CyclingData.aggregate_time_in_zones([self],column,zones,freq=None).iloc[0]
+    
+    @staticmethod
+    def aggregate_time_in_zones(
+        activities:list,
+        column:Literal["watts","power","heart_rate"],
+        zones:np.ndarray,
+        freq:Literal["W","M",None]="W"
+    )->pd.DataFrame:
+        """
+        Time spent in each zone, summed over all the activities by week or month.
+        All the samples are binned at once (np.digitize then np.bincount weighted by time_delta), so the whole history can be recomputed when the zones change.
+
+        Args:
+            activities (list[CyclingData | pd.DataFrame]): activities, or their data (CyclingData.get_data(), frames stored by ActivityWatcher)
+            column (str): quantity to split into zones, activities without this column (e.g. "power" without power meter) are ignored and add no period
+            zones (np.ndarray): lower bounds of zones 2 to n (see get_power_zones and get_heart_rate_zones)
+            freq (str, optional): "W" (week) or "M" (month), None to sum over all the activities. Defaults to "W".
+
+        Returns:
+            pd.DataFrame: time spent in each zone (s), one row per period and one column per zone ("Z1" to "Zn")
+        """
+        frames = [activity.data if isinstance(activity,CyclingData) else activity for activity in activities]
+        assert len(frames)>0,"Please provide at least one activity"
+        frames = [frame for frame in frames if column in frame.columns] # e.g. "power" without power meter
+        zones = np.asarray(zones,dtype=float)
+        n_zones = len(zones)+1
+        labels = [f"Z{i+1}" for i in range(n_zones)]
+        
+        if len(frames)==0:
+            index = pd.Index(["total"]) if freq is None else pd.PeriodIndex([],freq=freq,name="period")
+            return pd.DataFrame(0.0,index=index,columns=labels)
+        
+        values = np.concatenate([frame[column].to_numpy(dtype=float) for frame in frames])
+        time_delta = np.concatenate([frame["time_delta"].to_numpy(dtype=float) for frame in frames])
+        
+        if freq is None:
+            periods = np.zeros(len(values),dtype=int)
+            index = pd.Index(["total"])
+        else:
+            time = pd.Series(np.concatenate([frame["time"].to_numpy() for frame in frames]))
+            periods,index = pd.factorize(time.dt.to_period(freq),sort=True)
+            index = pd.PeriodIndex(index,name="period")
+        
+        valid = ~np.isnan(values) & ~np.isnan(time_delta) & (periods>=0) # missing time gives period -1
+        bins = periods[valid]*n_zones + np.digitize(values[valid],zones)
+        time_in_zones = np.bincount(bins,weights=time_delta[valid],minlength=len(index)*n_zones).astype(float)
+        
+        return pd.DataFrame(time_in_zones.reshape(len(index),n_zones),index=index,columns=labels)
+        
+        
+        
     ###########
     # PHYSICS #
     ###########
@@ -645,39 +795,127 @@ class CyclingData:
         self.data["altitude"] = self.data["altitude"].rolling(window=5,min_periods=1).median()
         print("Altitude data overwritten with IGN data")
     
+    @staticmethod
+    def air_density(altitude:float)->float:
+        """
+        Arguments can be passed as pd.DataSeries or np.ndarray too
+        
+        Args:
+            altitude (float): m
+
+        Returns:
+            rho: (kg/m³)
+        """
+        return CyclingData.rho0 * (1-CyclingData.L*altitude/CyclingData.T0) ** (CyclingData.g/(CyclingData.R*CyclingData.L)-1)
+    
     @staticmethod
     def compute_drag(
-        mass:float,
-        size:float,
+        cyclist:Cyclist,
         speed:float,
         altitude:float
     ):
         """
-        Arguments can be passed as pd.DataSeries too
+        Arguments speed and altitude can be passed as pd.DataSeries too
         
         Args:
-            mass (float): kg
-            size (float): m
+            cyclist (Cyclist): profile of the cyclist (CdA)
             speed (float): m/s
             altitude (float): m
         """
-        assert size<5,f"Size should be given in meters, and to my knowledge a man cannot be {size}m tall "
-        projected_frontal_area = 0.0293 * (size**0.725) * (mass**0.425) + 0.0604
-        rho = CyclingData.rho0 * (1-CyclingData.L*altitude/CyclingData.T0) ** (CyclingData.g/(CyclingData.R*CyclingData.L)-1)
-        kinetic_pressure = 0.5 * rho * speed**2
+        kinetic_pressure = 0.5 * CyclingData.air_density(altitude) * speed**2
         
-        return CyclingData.drag_coeffictient * projected_frontal_area * kinetic_pressure
+        return cyclist.cda * kinetic_pressure
     
     @staticmethod
     def set_cyclist(mass:float,size:float):
         """
+        Sets the default cyclist, used by the activities created afterwards without a cyclist.
+        Prefer CyclingData(filename,cyclist=Cyclist(mass,size)) to process several cyclists at the same time.
+        
         Args:
             mass (kg)
             size (m)
         """
         assert size < 5 ,"Size must be given in meters!"
-        CyclingData.mass = mass
-        CyclingData.size = size
+        CyclingData.cyclist = Cyclist(mass,size,CyclingData.cyclist.bike_mass)
+    
+    ###############
+    # CALIBRATION #
+    ###############
+    
+    @staticmethod
+    def fit_cyclist(activities:list,total_mass:float=None)->dict:
+        """
+        Fits CdA, rolling resistance and total mass (cyclist + bike) on activities recorded with a power meter.
+        The power balance is linear in the unknowns, so all the samples of all the activities are solved at once with a non-negative least squares:
+            power = M * (d(v²/2)/dt + g*dz/dt) + CdA * rho*v³/2 + (Crr*M) * g*v
+        Samples where the cyclist is not pedaling (power = 0) are ignored, since braking is not modeled.
+
+        Args:
+            activities (list[CyclingData]): activities, only those with a "power" column are used
+            total_mass (float, optional): known total mass (kg), only CdA and Crr are fitted if given. Defaults to None.
+
+        Returns:
+            dict: {"cda": m², "rolling_resistance": Crr, "total_mass": kg}
+        """
+        columns = ["power","speed","speed_delta","altitude","altitude_delta","time_delta"]
+        samples = [activity.data[columns] for activity in activities if "power" in activity.data.columns]
+        assert len(samples)>0,"Please provide at least one activity recorded with a power meter"
+        
+        data = pd.concat(samples).astype(float)
+        data = data[(data["power"]>0) & (data["time_delta"]>0)].dropna()
+        
+        speed = data["speed"].to_numpy()
+        previous_speed = speed - data["speed_delta"].to_numpy()
+        time_delta = data["time_delta"].to_numpy()
+        
+        power = data["power"].to_numpy()
+        mass_term = (0.5*(speed**2 - previous_speed**2) + CyclingData.g*data["altitude_delta"].to_numpy()) / time_delta
+        drag_term = 0.5 * CyclingData.air_density(data["altitude"].to_numpy()) * speed**3
+        rolling_term = CyclingData.g * speed
+        
+        if total_mass is None:
+            A = np.column_stack([mass_term,drag_term,rolling_term]) # total mass, CdA, Crr * total mass
+            total_mass,cda,rolling_mass = lsq_linear(A,power,bounds=(0,np.inf)).x
+        else:
+            A = np.column_stack([drag_term,rolling_term]) # CdA, Crr * total mass
+            cda,rolling_mass = lsq_linear(A,power - total_mass*mass_term,bounds=(0,np.inf)).x
+        
+        assert total_mass>0 and cda>0,f"Calibration failed (mass={total_mass:.1f} kg, CdA={cda:.3f} m²), power data may be too noisy"
+        return {
+            "cda":float(cda),
+            "rolling_resistance":float(rolling_mass/total_mass),
+            "total_mass":float(total_mass),
+        }
+    
+    @staticmethod
+    def calibrate(activities:list,fit_mass:bool=False)->Cyclist:
+        """
+        Fits CdA and rolling resistance on activities recorded with a power meter (see CyclingData.fit_cyclist), and recomputes the watts of the given activities with them.
+        All the activities must belong to the same cyclist (profile of the first activity).
+        By default the total mass is not calibrated: the fitted mass mostly comes from the noisy altitude deltas of the GPS.
+        In any case the declared mass of the cyclist is kept, since it is used for the per kg metrics (W/kg, VO2max).
+
+        Args:
+            activities (list[CyclingData]): activities, only those with a "power" column are used for the fit
+            fit_mass (bool, optional): also fit the total mass, the difference with the declared total mass goes into bike_mass. Defaults to False.
+
+        Returns:
+            Cyclist: profile with the fitted CdA and rolling resistance (and bike_mass if fit_mass), to be given to the next activities of this cyclist
+        """
+        base = activities[0].cyclist
+        fit = CyclingData.fit_cyclist(activities,total_mass=None if fit_mass else base.total_mass)
+        assert fit["total_mass"]>base.mass,f"Fitted total mass ({fit['total_mass']:.1f} kg) is lower than the mass of the cyclist ({base.mass} kg)"
+        cyclist = replace(
+            base,
+            bike_mass=fit["total_mass"] - base.mass,
+            cda=fit["cda"],
+            rolling_resistance=fit["rolling_resistance"]
+        )
+        
+        for activity in activities:
+            activity.set_profile(cyclist)
+        return cyclist
     
     @staticmethod
     def _show_file_structure(filename:str):
@@ -693,7 +931,7 @@ class CyclingData:
     
     def show_heart_beat_distribution(self):
         
-        if self.get_data()["heart_rate"].max()<1:
+        if self.data["heart_rate"].isna().all():
             print("No heart rate data available")
             return
         